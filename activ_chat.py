@@ -1,8 +1,25 @@
 # meta developer: @lir1mod
 
+import asyncio
+import collections
+import contextlib
+import csv
+import heapq
+import os
+import re
+import tempfile
 import time
 from telethon import TelegramClient
-from telethon.tl.types import Message
+from telethon.tl.types import (
+    ChannelParticipantAdmin,
+    ChannelParticipantCreator,
+    ChannelParticipantsAdmins,
+    ChatParticipantAdmin,
+    ChatParticipantCreator,
+    Message,
+    User,
+)
+from telethon.utils import get_peer_id
 from .. import loader, utils
 
 @loader.tds
@@ -27,80 +44,477 @@ class ChatActivityMod(loader.Module):
         ),
         "_cmd_doc_activchat": "Знаходить топ-40 активних користувачів (спамерів) у чаті.",
         "_cls_doc": "Модуль для аналізу активності користувачів у чаті.",
+        "cfg_live_counters": (
+            "Рахувати нові повідомлення одразу, щоб наступний .activchat не"
+            " переглядав їх знову. Працює для чатів, уже переглянутих після запуску."
+        ),
+        "cfg_scan_concurrency": "Скільки частин історії чату переглядати одночасно.",
+        "cfg_bucket_retention_days": (
+            "Скільки днів зберігати погодинну статистику для --since та --hist."
+        ),
+        "hist": "\n<code>{}</code>",
+        "window": "\n<i>За останні: {}</i>",
+        "progress": (
+            "<emoji document_id=5188311512791393083>🔎</emoji> <b>Шукаю найбільш активних"
+            " користувачів у чаті...</b>\n\nПереглянуто: {} повідомлень\nШвидкість: {} повідомлень/с"
+            "\nЗалишилось: ~{} с\n\n<i>Зупинити: .activchatstop</i>"
+        ),
+        "partial": "\n<i>Пошук зупинено, результат неповний.</i>",
+        "already_running": "<b>Пошук у цьому чаті вже триває.</b> Зупинити: <code>.activchatstop</code>",
+        "not_running": "<b>У цьому чаті немає активного пошуку.</b>",
+        "error": "<b>Помилка під час пошуку:</b> <code>{}</code>",
+        "export": "📄 <b>Кількість повідомлень усіх користувачів</b>",
+        "cfg_result_cache_ttl": (
+            "Скільки секунд використовувати останній результат чату повторно,"
+            " наприклад для іншої кількості користувачів."
+        ),
+        "_cmd_doc_activchatstop": "Зупиняє пошук і показує результат за вже переглянуті повідомлення.",
     }
 
-    async def get_active_participants(self, client: TelegramClient, chat_id):
-        active_users = {}
-        async for participant in client.iter_participants(chat_id):
-            if not participant.bot:  
-                active_users[participant.id] = participant
-        return active_users
+    _admin_cache_ttl = 600
+    _min_chunk_size = 2000
+    _bars = "▁▂▃▄▅▆▇█"
+    _progress_interval = 5
+
+    def __init__(self):
+        self.config = loader.ModuleConfig(
+            loader.ConfigValue(
+                "live_counters",
+                False,
+                lambda: self.strings["cfg_live_counters"],
+                validator=loader.validators.Boolean(),
+            ),
+            loader.ConfigValue(
+                "scan_concurrency",
+                4,
+                lambda: self.strings["cfg_scan_concurrency"],
+                validator=loader.validators.Integer(minimum=1, maximum=16),
+            ),
+            loader.ConfigValue(
+                "result_cache_ttl",
+                300,
+                lambda: self.strings["cfg_result_cache_ttl"],
+                validator=loader.validators.Integer(minimum=0),
+            ),
+            loader.ConfigValue(
+                "bucket_retention_days",
+                30,
+                lambda: self.strings["cfg_bucket_retention_days"],
+                validator=loader.validators.Integer(minimum=1, maximum=365),
+            ),
+        )
+        self._admin_cache = {}
+        self._counters = {}
+        self._dirty = set()
+        self._scans = {}
+        self._results = {}
+        self._scan_tasks = set()
 
-    async def get_admin_status(self, client: TelegramClient, chat_id, user_id):
+    async def resolve_users(self, client: TelegramClient, user_ids):
         try:
-            member = await client.get_permissions(chat_id, user_id)
-            if member.is_admin:
-                if member.ban_users or member.add_admins:
-                    return "senior"  
-                else:
-                    return "junior"  
+            entities = await client.get_entity(user_ids)
         except Exception:
-            return None  
+            entities = []
+            for user_id in user_ids:
+                with contextlib.suppress(Exception):
+                    entities.append(await client.get_entity(user_id))
+        return {entity.id: entity for entity in entities if isinstance(entity, User)}
+
+    async def get_top_users(self, client: TelegramClient, counts, quantity):
+        heap = [(-count, user_id) for user_id, count in counts.items() if user_id > 0]
+        heapq.heapify(heap)
+        top_users = []
+        while heap and len(top_users) < quantity:
+            batch = [heapq.heappop(heap) for _ in range(min(quantity - len(top_users), len(heap)))]
+            users = await self.resolve_users(client, [user_id for _, user_id in batch])
+            for count, user_id in batch:
+                user = users.get(user_id)
+                if user and not user.bot:
+                    top_users.append((user, -count))
+        return top_users
+
+    async def get_admin_roles(self, client: TelegramClient, chat_id):
+        cache_key = get_peer_id(chat_id)
+        cached = self._admin_cache.get(cache_key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        admin_roles = {}
+        try:
+            async for admin in client.iter_participants(chat_id, filter=ChannelParticipantsAdmins):
+                # basic groups ignore the filter and list every member, so roles
+                # come from the participant type
+                participant = admin.participant
+                if isinstance(participant, (ChannelParticipantCreator, ChatParticipantCreator, ChatParticipantAdmin)):
+                    admin_roles[admin.id] = "senior"
+                elif isinstance(participant, ChannelParticipantAdmin):
+                    rights = participant.admin_rights
+                    admin_roles[admin.id] = "senior" if rights.ban_users or rights.add_admins else "junior"
+        except Exception:
+            # not cached, so a transient failure doesn't hide the admins for the whole TTL
+            return admin_roles
+
+        self._admin_cache[cache_key] = (time.monotonic() + self._admin_cache_ttl, admin_roles)
+        return admin_roles
           
-    async def count_messages(self, client: TelegramClient, chat_id, active_users, limit=None):
-        user_message_count = {}
-        async for msg in client.iter_messages(chat_id, limit=limit):
-            user_id = msg.sender_id
-            if user_id and user_id in active_users:
-                user_message_count[user_id] = user_message_count.get(user_id, 0) + 1
-        return user_message_count
+    async def count_messages(self, client: TelegramClient, chat_id, counts, limit=None, min_id=0, max_id=None, buckets=None, progress=None):
+        offset_id = max_id + 1 if max_id else 0
+        max_id = min_id
+        oldest_hour = self.oldest_bucket_hour()
+        async for msg in client.iter_messages(chat_id, limit=limit, min_id=min_id, offset_id=offset_id):
+            max_id = max(max_id, msg.id)
+            if progress is not None:
+                progress["scanned"] += 1
+            if msg.sender_id:
+                counts[msg.sender_id] += 1
+                if buckets is not None and msg.date:
+                    hour = int(msg.date.timestamp()) // 3600
+                    if hour >= oldest_hour:
+                        buckets[hour][msg.sender_id] += 1
+        return max_id
+
+    async def count_messages_chunked(self, client: TelegramClient, chat_id, counts, buckets, min_id=0, progress=None):
+        latest = await client.get_messages(chat_id, limit=1)
+        if not latest or latest[0].id <= min_id:
+            return min_id
+
+        max_id = latest[0].id
+        if progress is not None:
+            progress["total"] = max_id - min_id
+        concurrency = self.config["scan_concurrency"]
+        chunk_size = max(self._min_chunk_size, -(-(max_id - min_id) // (concurrency * 4)))
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def scan_chunk(low, high):
+            chunk_counts = collections.Counter()
+            chunk_buckets = collections.defaultdict(collections.Counter)
+            if progress is not None:
+                # kept reachable so a cancelled scan can still report what it counted
+                progress["chunks"].append((chunk_counts, chunk_buckets))
+            async with semaphore:
+                await self.count_messages(
+                    client, chat_id, chunk_counts, min_id=low, max_id=high, buckets=chunk_buckets, progress=progress
+                )
+            return chunk_counts, chunk_buckets
+
+        for chunk_counts, chunk_buckets in await asyncio.gather(
+            *(scan_chunk(low, min(low + chunk_size, max_id)) for low in range(min_id, max_id, chunk_size))
+        ):
+            counts.update(chunk_counts)
+            for hour, hour_counts in chunk_buckets.items():
+                buckets[hour].update(hour_counts)
+        return max_id
+
+    def oldest_bucket_hour(self):
+        return int(time.time()) // 3600 - self.config["bucket_retention_days"] * 24
+
+    def get_counters(self, chat_key):
+        if chat_key not in self._counters:
+            stored = self.get(f"counters_{chat_key}", None)
+            if not stored or "buckets" not in stored:
+                # counters saved without time buckets are rebuilt once
+                stored = {"max_id": 0, "counts": {}, "buckets": {}}
+            buckets = collections.defaultdict(collections.Counter)
+            for hour, hour_counts in stored["buckets"].items():
+                buckets[int(hour)] = collections.Counter({int(k): v for k, v in hour_counts.items()})
+            self._counters[chat_key] = {
+                "max_id": stored["max_id"],
+                "counts": collections.Counter({int(k): v for k, v in stored["counts"].items()}),
+                "buckets": buckets,
+                "live": False,
+                "pending": None,
+            }
+        return self._counters[chat_key]
+
+    def save_counters(self, chat_key):
+        counters = self._counters[chat_key]
+        oldest_hour = self.oldest_bucket_hour()
+        for hour in [hour for hour in counters["buckets"] if hour < oldest_hour]:
+            del counters["buckets"][hour]
+        self.set(
+            f"counters_{chat_key}",
+            {
+                "max_id": counters["max_id"],
+                "counts": {str(k): v for k, v in counters["counts"].items()},
+                "buckets": {
+                    str(hour): {str(k): v for k, v in hour_counts.items()}
+                    for hour, hour_counts in counters["buckets"].items()
+                },
+            },
+        )
+        self._dirty.discard(chat_key)
+
+    async def update_counters(self, client: TelegramClient, chat_id, progress=None):
+        chat_key = get_peer_id(chat_id)
+        counters = self.get_counters(chat_key)
+        # the watcher buffers new messages while the scan runs, they are applied
+        # above the scanned range so nothing is counted twice or skipped
+        counters["pending"] = []
+        try:
+            scanned_max = await self.count_messages_chunked(
+                client, chat_id, counters["counts"], counters["buckets"], min_id=counters["max_id"], progress=progress
+            )
+            counters["max_id"] = max(counters["max_id"], scanned_max)
+            for msg_id, sender_id, hour in sorted(counters["pending"]):
+                self.count_live(counters, msg_id, sender_id, hour)
+            counters["live"] = True
+        except BaseException:
+            counters["live"] = False
+            raise
+        finally:
+            counters["pending"] = None
+        self.save_counters(chat_key)
+        return counters
+
+    @staticmethod
+    def count_live(counters, msg_id, sender_id, hour):
+        if msg_id <= counters["max_id"]:
+            return
+        counters["counts"][sender_id] += 1
+        if hour is not None:
+            counters["buckets"][hour][sender_id] += 1
+        counters["max_id"] = msg_id
+
+    @staticmethod
+    def window_counts(buckets, since_hour):
+        counts = collections.Counter()
+        for hour, hour_counts in buckets.items():
+            if hour >= since_hour:
+                counts.update(hour_counts)
+        return counts
+
+    def histogram(self, buckets, user_id, since_hour, step):
+        now_hour = int(time.time()) // 3600
+        start = max(since_hour, self.oldest_bucket_hour())
+        values = [
+            sum(buckets[hour].get(user_id, 0) for hour in range(period, min(period + step, now_hour + 1)) if hour in buckets)
+            for period in range(start, now_hour + 1, step)
+        ]
+        peak = max(values, default=0) or 1
+        return "".join(self._bars[round(value / peak * (len(self._bars) - 1))] for value in values)
+
+    @staticmethod
+    def parse_window(value):
+        match = re.fullmatch(r"(\d+)([hd])", value or "")
+        if not match:
+            return None
+        return int(match.group(1)) * (24 if match.group(2) == "d" else 1)
+
+    def parse_args(self, args):
+        options = {"quantity": 40, "limit": None, "since": None, "hist": False, "export": False}
+        tokens = args.split()
+        while tokens:
+            token = tokens.pop(0)
+            if token.startswith("-m"):
+                value = token[2:] or (tokens.pop(0) if tokens else "")
+                if value.isdigit():
+                    options["limit"] = int(value)
+            elif token == "--since":
+                options["since"] = self.parse_window(tokens.pop(0) if tokens else "")
+            elif token == "--hist":
+                options["hist"] = True
+            elif token == "--export":
+                options["export"] = True
+            elif token.isdigit():
+                options["quantity"] = int(token)
+        return options
+
+    @loader.watcher("only_messages")
+    async def watcher(self, message: Message):
+        if not self.config["live_counters"] or not message.sender_id:
+            return
+        chat_key = get_peer_id(message.peer_id)
+        counters = self._counters.get(chat_key)
+        if not counters:
+            return
+        hour = int(message.date.timestamp()) // 3600 if message.date else None
+        if counters["pending"] is not None:
+            counters["pending"].append((message.id, message.sender_id, hour))
+            return
+        # only chats scanned in this session, restarts leave gaps the next scan fills
+        if not counters["live"]:
+            return
+        self.count_live(counters, message.id, message.sender_id, hour)
+        self._dirty.add(chat_key)
+
+    @loader.loop(interval=60, autostart=True)
+    async def counters_saver(self):
+        for chat_key in list(self._dirty):
+            self.save_counters(chat_key)
+
+    async def collect_counts(self, client: TelegramClient, chat_id, options, progress):
+        if options["limit"] and not (options["since"] or options["hist"]):
+            progress["total"] = options["limit"]
+            counts = collections.Counter()
+            progress["chunks"].append((counts, None))
+            await self.count_messages(client, chat_id, counts, options["limit"], progress=progress)
+            return counts, None
+
+        counters = await self.update_counters(client, chat_id, progress)
+        return counters["counts"], counters["buckets"]
+
+    def partial_counts(self, chat_id, options, progress):
+        counts = collections.Counter()
+        buckets = collections.defaultdict(collections.Counter)
+        if not options["limit"] or options["since"] or options["hist"]:
+            counters = self.get_counters(get_peer_id(chat_id))
+            counts.update(counters["counts"])
+            for hour, hour_counts in counters["buckets"].items():
+                buckets[hour].update(hour_counts)
+        for chunk_counts, chunk_buckets in progress["chunks"]:
+            counts.update(chunk_counts)
+            for hour, hour_counts in (chunk_buckets or {}).items():
+                buckets[hour].update(hour_counts)
+        return counts, buckets
+
+    async def report_progress(self, search_message, progress):
+        while True:
+            await asyncio.sleep(self._progress_interval)
+            elapsed = time.perf_counter() - progress["started"]
+            rate = progress["scanned"] / elapsed if elapsed else 0
+            left = max(progress["total"] - progress["scanned"], 0)
+            eta = round(left / rate) if rate and progress["total"] else "?"
+            with contextlib.suppress(Exception):
+                await search_message.edit(
+                    self.strings["progress"].format(progress["scanned"], round(rate), eta)
+                )
+
+    async def run_scan(self, client: TelegramClient, search_message, chat_id, options):
+        chat_key = get_peer_id(chat_id)
+        start_time = time.perf_counter()
+        cache_key = (chat_key, None if options["since"] or options["hist"] else options["limit"])
+        cached = self._results.get(cache_key)
+        if cached and cached[0] > time.monotonic():
+            user_message_count, buckets = cached[1]
+            partial = False
+            self._scans.pop(chat_key, None)
+        else:
+            progress = {"scanned": 0, "total": 0, "started": start_time, "chunks": []}
+            scan = asyncio.ensure_future(self.collect_counts(client, chat_id, options, progress))
+            self._scans[chat_key] = scan
+            reporter = asyncio.ensure_future(self.report_progress(search_message, progress))
+            partial = False
+            try:
+                user_message_count, buckets = await asyncio.shield(scan)
+                now = time.monotonic()
+                self._results = {key: value for key, value in self._results.items() if value[0] > now}
+                self._results[cache_key] = (
+                    now + self.config["result_cache_ttl"],
+                    (user_message_count.copy(), buckets),
+                )
+            except asyncio.CancelledError:
+                if not scan.cancelled():
+                    # the task itself is cancelled (e.g. on unload), not stopped by .activchatstop
+                    scan.cancel()
+                    raise
+                user_message_count, buckets = self.partial_counts(chat_id, options, progress)
+                partial = True
+            except Exception as e:
+                return await self.show_error(search_message, e)
+            finally:
+                reporter.cancel()
+                self._scans.pop(chat_key, None)
+
+        try:
+            await self.render_result(
+                client, search_message, chat_id, options, user_message_count, buckets, start_time, partial
+            )
+        except Exception as e:
+            await self.show_error(search_message, e)
+
+    async def show_error(self, search_message, error):
+        with contextlib.suppress(Exception):
+            await search_message.edit(self.strings["error"].format(utils.escape_html(str(error))))
 
     @loader.command("activchat", description="Знаходить топ-40 активних користувачів (спамерів) у чаті.")
     async def activchat(self, message: Message):
-        """[кількість] [-m <int>] - Знаходить топ-40 спамерів у чаті."""
+        """[кількість] [-m <int>] [--since 24h/7d/30d] [--hist] [--export] - Знаходить топ-40 спамерів у чаті."""
         client = message.client  
-        args = utils.get_args_raw(message)
-        limit = None
+        options = self.parse_args(utils.get_args_raw(message))
 
-        if "-m" in args:
-            limit = int("".join([lim for lim in args[args.find("-m") + 2:] if lim.isdigit()]))
-            args = args[: args.find("-m")].strip()
+        chat_key = get_peer_id(message.peer_id)
+        if chat_key in self._scans:
+            return await utils.answer(message, self.strings["already_running"])
 
-        quantity = int(args) if args.isdigit() else 40  
-
-        search_message = await client.send_message(message.peer_id, self.strings["searching"])
+        # reserved before the first await, run_scan replaces it with the scan
+        self._scans[chat_key] = None
+        try:
+            search_message = await client.send_message(message.peer_id, self.strings["searching"])
+            await message.delete()
+        except Exception:
+            self._scans.pop(chat_key, None)
+            raise
 
-        await message.delete()
+        task = asyncio.ensure_future(self.run_scan(client, search_message, message.peer_id, options))
+        self._scan_tasks.add(task)
+        task.add_done_callback(self._scan_tasks.discard)
 
-        start_time = time.perf_counter()
+    @loader.command("activchatstop", description="Зупиняє пошук активних користувачів у чаті.")
+    async def activchatstop(self, message: Message):
+        """Зупиняє пошук і показує результат за вже переглянуті повідомлення."""
+        scan = self._scans.get(get_peer_id(message.peer_id))
+        if not scan:
+            return await utils.answer(message, self.strings["not_running"])
 
-        chat_id = message.peer_id
-        active_users = await self.get_active_participants(client, chat_id)
+        scan.cancel()
+        await message.delete()
 
-        user_message_count = await self.count_messages(client, chat_id, active_users, limit)
+    async def render_result(self, client: TelegramClient, search_message, chat_id, options, user_message_count, buckets, start_time, partial):
+        quantity = options["quantity"]
+        window_hours = min(options["since"] or 10 ** 9, self.config["bucket_retention_days"] * 24)
+        since_hour = int(time.time()) // 3600 - window_hours + 1
+        if options["since"]:
+            user_message_count = self.window_counts(buckets, since_hour)
 
-        sorted_users = sorted(user_message_count.items(), key=lambda x: x[1], reverse=True)
+        top_users = await self.get_top_users(client, user_message_count, quantity)
+        admin_roles = await self.get_admin_roles(client, chat_id)
 
         admins_senior = []
         admins_junior = []
         regular_users = []
 
-        for i, (user_id, count) in enumerate(sorted_users[:quantity]):
-            user = active_users[user_id]
-            admin_status = await self.get_admin_status(client, chat_id, user_id)
+        for i, (user, count) in enumerate(top_users):
+            admin_status = admin_roles.get(user.id)
+            hist = ""
+            if options["hist"]:
+                step = 1 if window_hours <= 48 else 24
+                hist = self.strings["hist"].format(self.histogram(buckets, user.id, since_hour, step))
 
             if admin_status == "senior":
-                admins_senior.append(self.strings["admin_senior"].format(i + 1, user.username, user.first_name, count))
+                admins_senior.append(self.strings["admin_senior"].format(i + 1, user.username, user.first_name, count) + hist)
             elif admin_status == "junior":
-                admins_junior.append(self.strings["admin_junior"].format(i + 1, user.username, user.first_name, count))
+                admins_junior.append(self.strings["admin_junior"].format(i + 1, user.username, user.first_name, count) + hist)
             else:
-                regular_users.append(self.strings["regular"].format(i + 1, user.username, user.first_name, count))
+                regular_users.append(self.strings["regular"].format(i + 1, user.username, user.first_name, count) + hist)
 
         admins_column = "\n".join(admins_senior + admins_junior) if (admins_senior or admins_junior) else "Немає адміністраторів"
         regular_column = "\n".join(regular_users) if regular_users else "Немає звичайних користувачів"
 
-        await search_message.edit(
-            self.strings["active"].format(
-                admins_column, regular_column, round(time.perf_counter() - start_time, 2)
-            )
+        text = self.strings["active"].format(
+            admins_column, regular_column, round(time.perf_counter() - start_time, 2)
         )
+        if options["since"]:
+            text += self.strings["window"].format(
+                f"{window_hours // 24} дн." if window_hours % 24 == 0 else f"{window_hours} год."
+            )
+        if partial:
+            text += self.strings["partial"]
+        await search_message.edit(text)
+
+        if options["export"]:
+            await self.export_csv(client, search_message, user_message_count)
+
+    async def export_csv(self, client: TelegramClient, search_message, user_message_count):
+        with tempfile.NamedTemporaryFile(
+            "w", prefix="activchat_", suffix=".csv", newline="", encoding="utf-8", delete=False
+        ) as file:
+            writer = csv.writer(file)
+            writer.writerow(["rank", "user_id", "messages"])
+            for rank, (user_id, count) in enumerate(
+                sorted(user_message_count.items(), key=lambda x: x[1], reverse=True), start=1
+            ):
+                writer.writerow([rank, user_id, count])
+        try:
+            await client.send_file(search_message.peer_id, file.name, caption=self.strings["export"])
+        finally:
+            os.remove(file.name)
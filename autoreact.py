@@ -1,19 +1,81 @@
-__version__ = (0, 1, 29)
+__version__ = (0, 1, 36)
 
 # meta developer: @SodaModules
 
 import asyncio
+import collections
+import hashlib
+import heapq
+import json
 import logging
+import os
 import random
+import time
+import typing
 
-from telethon.errors import ReactionInvalidError
-from telethon.tl.types import Message
+from telethon.errors import FloodWaitError, ReactionInvalidError
+from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.tl.functions.messages import GetFullChatRequest
+from telethon.tl.types import (
+    ChatReactionsNone,
+    ChatReactionsSome,
+    Message,
+    PeerChannel,
+    PeerChat,
+    ReactionEmoji,
+)
 
 from .. import loader, utils
 
 logger = logging.getLogger(__name__)
 
 
+class ReactionRule(typing.NamedTuple):
+    userid: typing.Union[int, str]
+    chatid: typing.Union[int, str]
+    emojis: tuple
+    source: str
+
+
+class PendingReaction(typing.NamedTuple):
+    due: float
+    seq: int
+    message: Message
+    rule: ReactionRule
+    emojis: tuple
+    scheduled: float
+    queued: float
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.rate,
+        )
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
 @loader.tds
 class AutoReactMod(loader.Module):
     """
@@ -56,6 +118,45 @@ class AutoReactMod(loader.Module):
             "Pattern:\n<userid/all>|<chatid/global>|<percentage(0.00-1)>\n\nExample:\n1234567|global|0.8"
         ),
         "_cfg_doc_shuffle_chats": "A list of chats where the emoji list is shuffled.",
+        "backlog_usage": "<b>Usage:</b> <code>{}autoreactbacklog &lt;chat&gt; &lt;N&gt;</code>",
+        "backlog_no_chat": "<b>Chat not found.</b>",
+        "backlog_started": "<b>Scanning chat history...</b>",
+        "backlog_progress": (
+            "<b>Scanning chat history...</b>\nScanned: {}/{}\nQueued reactions: {}"
+        ),
+        "backlog_done": "<b>Backlog done.</b>\nScanned: {}\nQueued reactions: {}",
+        "backlog_error": "<b>Backlog failed:</b> <code>{}</code>",
+        "_cfg_doc_stats_dump_path": (
+            "Path of a local JSON file where the rule statistics are written every"
+            " 5 minutes.\nEmpty disables it."
+        ),
+        "stats_empty": "<b>No AutoReact statistics yet.</b>",
+        "stats_reset": "<b>AutoReact statistics cleared.</b>",
+        "stats_header": "<b>AutoReact statistics:</b>\n\n",
+        "stats_rule": (
+            "<code>{rule}</code>\nmatched: {matched}, skipped by chance:"
+            " {skipped_chance}, sent: {success} (fallback: {fallback})\ninvalid:"
+            " {invalid}, premium required: {premium_required}, errors: {errors},"
+            " dropped: {dropped}, no reaction: {no_reaction}\navg delay: {delay}s,"
+            " avg latency: {latency}s\n\n"
+        ),
+        "_cfg_doc_max_concurrent": (
+            "How many reactions can be sent at the same time.\nDelayed reactions"
+            " are queued and sent when due."
+        ),
+        "_cfg_doc_rate_limit": (
+            "How many reactions per second can be sent in total.\nOn FloodWait"
+            " the queue is paused for the time given by Telegram."
+        ),
+        "_cfg_doc_chat_rate_limit": "How many reactions per second can be sent to one chat.",
+        "_cfg_doc_max_age": (
+            "Queued reactions which are late by more than this many seconds are"
+            " dropped.\n0 disables it."
+        ),
+        "_cfg_doc_reactions_cache_ttl": (
+            "How long (in seconds) the allowed reactions of a chat and the"
+            " emojis which failed there are remembered."
+        ),
     }
 
     strings_en = {}
@@ -97,8 +198,51 @@ class AutoReactMod(loader.Module):
         "_cfg_doc_shuffle_chats": (
             "Список чатів, у яких перемішується список емодзі."
         ),
+        "_cfg_doc_max_concurrent": (
+            "Скільки реакцій може надсилатися одночасно.\nРеакції із затримкою"
+            " стають у чергу і надсилаються у свій час."
+        ),
+        "_cfg_doc_rate_limit": (
+            "Скільки реакцій на секунду можна надсилати загалом.\nПри FloodWait"
+            " черга зупиняється на час, вказаний Telegram."
+        ),
+        "_cfg_doc_chat_rate_limit": "Скільки реакцій на секунду можна надсилати в один чат.",
+        "_cfg_doc_max_age": (
+            "Реакції в черзі, які запізнюються більше ніж на стільки секунд,"
+            " відкидаються.\n0 вимикає це."
+        ),
+        "_cfg_doc_reactions_cache_ttl": (
+            "Скільки секунд пам'ятати дозволені реакції чату та емодзі, які"
+            " там не спрацювали."
+        ),
         "_cls_doc": "міша гей Автореакція на повідомлення.\nПеревірте .config apodiktum autoreact.",
         "_cmd_doc_cautoreact": "Це відкриє налаштування модуля міша гей",
+        "_cmd_doc_autoreactbacklog": (
+            "<чат> <N> - Застосувати правила реакцій до останніх N повідомлень чату."
+        ),
+        "backlog_usage": "<b>Використання:</b> <code>{}autoreactbacklog &lt;чат&gt; &lt;N&gt;</code>",
+        "backlog_no_chat": "<b>Чат не знайдено.</b>",
+        "backlog_started": "<b>Переглядаю історію чату...</b>",
+        "backlog_progress": (
+            "<b>Переглядаю історію чату...</b>\nПереглянуто: {}/{}\nРеакцій у черзі: {}"
+        ),
+        "backlog_done": "<b>Готово.</b>\nПереглянуто: {}\nРеакцій у черзі: {}",
+        "backlog_error": "<b>Помилка:</b> <code>{}</code>",
+        "_cmd_doc_autoreactstats": "[reset] - Статистика спрацювань правил реакцій.",
+        "_cfg_doc_stats_dump_path": (
+            "Шлях до локального JSON файлу, куди кожні 5 хвилин записується"
+            " статистика правил.\nПорожнє значення вимикає це."
+        ),
+        "stats_empty": "<b>Статистики AutoReact ще немає.</b>",
+        "stats_reset": "<b>Статистику AutoReact очищено.</b>",
+        "stats_header": "<b>Статистика AutoReact:</b>\n\n",
+        "stats_rule": (
+            "<code>{rule}</code>\nзбігів: {matched}, пропущено через шанс:"
+            " {skipped_chance}, надіслано: {success} (запасних: {fallback})\nневірних:"
+            " {invalid}, потрібен преміум: {premium_required}, помилок: {errors},"
+            " відкинуто: {dropped}, без реакції: {no_reaction}\nсер. затримка:"
+            " {delay}с, сер. час до реакції: {latency}с\n\n"
+        ),
     }
 
     all_strings = {
@@ -108,6 +252,18 @@ class AutoReactMod(loader.Module):
         "strings_ua": strings_ua,
     }
 
+    _stats_fields = (
+        "matched",
+        "skipped_chance",
+        "success",
+        "fallback",
+        "invalid",
+        "premium_required",
+        "errors",
+        "dropped",
+        "no_reaction",
+    )
+
     changes = {
         "migration1": {
             "name": {
@@ -186,6 +342,45 @@ class AutoReactMod(loader.Module):
                     loader.validators.TelegramID(),
                 ),
             ),
+            loader.ConfigValue(
+                "max_concurrent",
+                5,
+                doc=lambda: self.strings("_cfg_doc_max_concurrent"),
+                validator=loader.validators.Integer(minimum=1),
+            ),
+            loader.ConfigValue(
+                "rate_limit",
+                2.0,
+                doc=lambda: self.strings("_cfg_doc_rate_limit"),
+                validator=loader.validators.Float(minimum=0.01),
+            ),
+            loader.ConfigValue(
+                "chat_rate_limit",
+                0.5,
+                doc=lambda: self.strings("_cfg_doc_chat_rate_limit"),
+                validator=loader.validators.Float(minimum=0.01),
+            ),
+            loader.ConfigValue(
+                "max_age",
+                300,
+                doc=lambda: self.strings("_cfg_doc_max_age"),
+                validator=loader.validators.Integer(minimum=0),
+            ),
+            loader.ConfigValue(
+                "reactions_cache_ttl",
+                3600,
+                doc=lambda: self.strings("_cfg_doc_reactions_cache_ttl"),
+                validator=loader.validators.Integer(minimum=0),
+            ),
+            loader.ConfigValue(
+                "stats_dump_path",
+                None,
+                doc=lambda: self.strings("_cfg_doc_stats_dump_path"),
+                validator=loader.validators.Union(
+                    loader.validators.String(),
+                    loader.validators.NoneType(),
+                ),
+            ),
             loader.ConfigValue(
                 "auto_migrate",
                 True,
@@ -193,18 +388,61 @@ class AutoReactMod(loader.Module):
                 validator=loader.validators.Boolean(),
             ),  # for MigratorClass
         )
+        self._rules = {}
+        self._chances = {}
+        self._reactions_src = None
+        self._reactions_chance_src = None
+        self._pending = []
+        self._inflight = set()
+        self._wakeup = asyncio.Event()
+        self._seq = 0
+        self._allowed_cache = {}
+        self._allowed_fetching = {}
+        self._invalid_reactions = {}
+        self._bucket = None
+        self._chat_buckets = {}
+        self._paused_until = 0
+        self._backlog_tasks = set()
+        self._backlog_window = 50
+        self._stats = {}
 
     async def client_ready(self):
-        self.apo_lib = await self.import_lib(
-            "https://raw.githubusercontent.com/anon97945/hikka-libs/master/apodiktum_library.py",
-            suspend_on_error=True,
-        )
-        await self.apo_lib.migrator.auto_migrate_handler(
-            self.__class__.__name__,
-            self.strings("name"),
-            self.changes,
-            self.config["auto_migrate"],
-        )
+        self._auto_migrate()
+
+    def _auto_migrate(self):
+        """
+        Applies the entries of `changes` which were not applied yet.
+        Local replacement for the apodiktum library migrator, so startup
+        doesn't depend on fetching it from GitHub. Applied migrations are
+        tracked the same way the library did (sha256 of the migration name
+        in "hashs"), and with auto_migrate off pending ones are only marked
+        as applied.
+        """
+        hashs = self.get("hashs", [])
+        for migration, categories in self.changes.items():
+            chash = hashlib.sha256(migration.encode("utf-8")).hexdigest()
+            if chash in hashs:
+                continue
+            name = categories.get("name")
+            if (
+                self.config["auto_migrate"]
+                and name
+                and name["new"] in (self.strings("name"), self.__class__.__name__)
+                and name["old"] in self._db
+            ):
+                old_config = self._db.get(name["old"], "__config__", {})
+                for option, value in old_config.items():
+                    if option not in self.config:
+                        continue
+                    try:
+                        self.config[option] = value
+                    except Exception:  # skipcq: PYL-W0703
+                        logger.debug("Can't migrate %s=%r", option, value)
+                self._db.pop(name["old"], None)
+                self._db.save()
+                logger.info("%s: applied %s", self.strings("name"), migration)
+            hashs.append(chash)
+        self.set("hashs", hashs)
 
     async def cautoreactcmd(self, message: Message):
         """
@@ -215,36 +453,435 @@ class AutoReactMod(loader.Module):
             await utils.answer(message, f"{self.get_prefix()}config {name}")
         )
 
-    @loader.watcher("only_messages")
-    async def watcher(self, message: Message):
-        if not self.config["reaction_active"]:
+    async def autoreactbacklogcmd(self, message: Message):
+        """
+        <chat> <N> - Apply the reaction rules to the last N messages of the chat.
+        """
+        args = utils.get_args(message)
+        if len(args) != 2 or not args[1].isdigit():
+            await utils.answer(
+                message,
+                self.strings("backlog_usage").format(self.get_prefix()),
+            )
+            return
+
+        chat = int(args[0]) if args[0].lstrip("-").isdigit() else args[0]
+        try:
+            entity = await self._client.get_entity(chat)
+        except Exception:  # skipcq: PYL-W0703
+            await utils.answer(message, self.strings("backlog_no_chat"))
             return
+
+        status = await utils.answer(message, self.strings("backlog_started"))
+        task = asyncio.ensure_future(self._backlog(status, entity, int(args[1])))
+        self._backlog_tasks.add(task)
+        task.add_done_callback(self._backlog_tasks.discard)
+
+    async def _backlog(self, status: Message, entity, limit: int):
+        scanned = queued = 0
+        last_report = time.monotonic()
+        try:
+            async for msg in self._client.iter_messages(entity, limit=limit):
+                scanned += 1
+                if not getattr(msg, "action", None) and not self._has_own_reaction(
+                    msg
+                ):
+                    reaction = await self._build_reaction(msg)
+                    if reaction:
+                        # keep the queue short, the rate limiter sets the pace
+                        while len(self._pending) >= self._backlog_window:
+                            await asyncio.sleep(1)
+                        rule, emoji_list = reaction
+                        self._schedule(msg, emoji_list, rule)
+                        queued += 1
+
+                if time.monotonic() - last_report >= 5:
+                    last_report = time.monotonic()
+                    status = await utils.answer(
+                        status,
+                        self.strings("backlog_progress").format(
+                            scanned, limit, queued
+                        ),
+                    )
+        except Exception as exc:  # skipcq: PYL-W0703
+            logger.exception("AutoReact backlog failed")
+            await utils.answer(status, self.strings("backlog_error").format(exc))
+            return
+
+        await utils.answer(
+            status,
+            self.strings("backlog_done").format(scanned, queued),
+        )
+
+    async def autoreactstatscmd(self, message: Message):
+        """
+        [reset] - Show how often each reaction rule fires.
+        """
+        if utils.get_args_raw(message) == "reset":
+            self._stats.clear()
+            await utils.answer(message, self.strings("stats_reset"))
+            return
+
+        if not self._stats:
+            await utils.answer(message, self.strings("stats_empty"))
+            return
+
+        text = self.strings("stats_header")
+        for rule, stats in sorted(
+            self._stats.items(),
+            key=lambda item: item[1]["matched"],
+            reverse=True,
+        )[:20]:
+            sent = stats["success"] or 1
+            text += self.strings("stats_rule").format(
+                rule=utils.escape_html(rule),
+                delay=round(stats["delay_total"] / sent, 2),
+                latency=round(stats["latency_total"] / sent, 2),
+                **{key: stats[key] for key in self._stats_fields},
+            )
+        await utils.answer(message, text)
+
+    @loader.loop(interval=300, autostart=True)
+    async def stats_dumper(self):
+        path = self.config["stats_dump_path"]
+        if not path or not self._stats:
+            return
+        try:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(self._stats, file, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception("Can't write AutoReact statistics to %s", path)
+
+    def _compile_rules(self):
+        """
+        Parse `reactions` and `reactions_chance` into dict indexes.
+        Only rebuilt when the config lists are replaced.
+        """
         reactions = self.config["reactions"]
         reactions_chance = self.config["reactions_chance"]
+        if (
+            reactions is self._reactions_src
+            and reactions_chance is self._reactions_chance_src
+        ):
+            return
 
+        rules = {}
         for reaction in reactions:
             userid, chatid, *emoji_list = reaction.split("|")
             if userid == "all" and chatid == "global":
-                return
+                # rejected by the validator, would match every message
+                continue
+            key = (
+                userid if userid == "all" else int(userid),
+                chatid if chatid == "global" else int(chatid),
+            )
+            rules.setdefault(key, []).append(
+                ReactionRule(key[0], key[1], tuple(emoji_list), reaction)
+            )
+
+        chances = {}
+        for r_chance in reactions_chance:
+            userid, chatid, chance = r_chance.split("|")
+            if userid == "all" and chatid == "global":
+                continue
+            key = (
+                userid if userid == "all" else int(userid),
+                chatid if chatid == "global" else int(chatid),
+            )
+            # every matching chance rule rolls independently
+            chances[key] = chances.get(key, 1.0) * float(chance)
+
+        self._rules = rules
+        self._chances = chances
+        self._reactions_src = reactions
+        self._reactions_chance_src = reactions_chance
+
+    @staticmethod
+    def _rule_keys(userid: int, chatid: int) -> tuple:
+        return ((userid, chatid), (userid, "global"), ("all", chatid))
+
+    def _match_rules(self, message: Message) -> list:
+        self._compile_rules()
+        userid = message.sender_id
+        chatid = utils.get_chat_id(message)
+        matched = []
+        for key in self._rule_keys(userid, chatid):
+            for rule in self._rules.get(key, ()):
+                if (
+                    rule.userid == "all"
+                    and self.config["ignore_self"]
+                    and message.out
+                ):
+                    continue
+                matched.append(rule)
+        return matched
+
+    @loader.watcher("only_messages")
+    async def watcher(self, message: Message):
+        if not self.config["reaction_active"]:
+            return
+        reaction = await self._build_reaction(message)
+        if reaction:
+            rule, emoji_list = reaction
+            self._schedule(
+                message,
+                emoji_list,
+                rule,
+                self._delay(rule.chatid, rule.userid),
+            )
+
+    async def _build_reaction(
+        self,
+        message: Message,
+    ) -> typing.Optional[typing.Tuple[ReactionRule, tuple]]:
+        """
+        Returns the first matching rule and the merged emoji fallback list,
+        or None if the message should not be reacted to.
+        """
+        rules = self._match_rules(message)
+        if not rules:
+            return None
+        self._rule_stats(rules[0])["matched"] += 1
+        if not await self._reactions_chance(self._chances, message):
+            self._rule_stats(rules[0])["skipped_chance"] += 1
+            return None
+
+        chatid = utils.get_chat_id(message)
+        emoji_list = []
+        for rule in rules:
+            emojis = rule.emojis
+            if chatid in self.config["shuffle_reactions"]:
+                emojis = random.sample(emojis, len(emojis))
+            emoji_list.extend(emoji for emoji in emojis if emoji not in emoji_list)
+        return rules[0], tuple(emoji_list)
+
+    @staticmethod
+    def _has_own_reaction(message: Message) -> bool:
+        return bool(
+            message.reactions
+            and any(
+                getattr(result, "chosen_order", None) is not None
+                for result in message.reactions.results
+            )
+        )
+
+    def _schedule(
+        self,
+        message: Message,
+        emoji_list: tuple,
+        rule: ReactionRule,
+        delay: float = 0,
+    ):
+        self._seq += 1
+        now = time.monotonic()
+        heapq.heappush(
+            self._pending,
+            PendingReaction(
+                now + delay,
+                self._seq,
+                message,
+                rule,
+                emoji_list,
+                now + delay,
+                now,
+            ),
+        )
+        self._wakeup.set()
+
+    def _requeue(self, pending: PendingReaction, due: float):
+        self._seq += 1
+        heapq.heappush(self._pending, pending._replace(due=due, seq=self._seq))
+        self._wakeup.set()
+
+    def _chat_bucket(self, chatid: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chatid)
+        if bucket is None or bucket.rate != self.config["chat_rate_limit"]:
+            bucket = self._chat_buckets[chatid] = TokenBucket(
+                self.config["chat_rate_limit"]
+            )
+        return bucket
+
+    @loader.loop(interval=0, autostart=True)
+    async def reaction_worker(self):
+        """
+        Fires the due reactions, then sleeps until the next one is due,
+        a limiter frees up or `_schedule` wakes it up.
+        """
+        self._wakeup.clear()
+        self._dispatch()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), self._next_wakeup())
+        except asyncio.TimeoutError:
+            pass
+
+    def _next_wakeup(self) -> typing.Optional[float]:
+        now = time.monotonic()
+        if self._paused_until > now:
+            return self._paused_until - now
+        if not self._pending or len(self._inflight) >= self.config["max_concurrent"]:
+            return None
+        wait = self._bucket.wait_time(now) if self._bucket else 0
+        return max(self._pending[0].due - now, wait)
+
+    def _dispatch(self):
+        now = time.monotonic()
+        if self._paused_until > now:
+            return
+
+        if self._bucket is None or self._bucket.rate != self.config["rate_limit"]:
+            self._bucket = TokenBucket(self.config["rate_limit"])
+
+        if not self._pending:
+            self._chat_buckets = {
+                chatid: bucket
+                for chatid, bucket in self._chat_buckets.items()
+                if not bucket.is_full(now)
+            }
+            return
+
+        while (
+            self._pending
+            and self._pending[0].due <= now
+            and len(self._inflight) < self.config["max_concurrent"]
+            and not self._bucket.wait_time(now)
+        ):
+            pending = heapq.heappop(self._pending)
             if (
-                (str(message.sender_id) == userid or userid == "all")
-                and (str(utils.get_chat_id(message)) == chatid or chatid == "global")
-                and not (userid == "all" and self.config["ignore_self"] and message.out)
+                self.config["max_age"]
+                and now - pending.scheduled > self.config["max_age"]
             ):
-                if not await self._reactions_chance(reactions_chance, message):
-                    return
-                if utils.get_chat_id(message) in self.config["shuffle_reactions"]:
-                    emoji_list = random.sample(emoji_list, len(emoji_list))
-                await self._delay(chatid, userid)
-                for emoji_reaction in emoji_list:
-                    if await self._react_message(message, emoji_reaction, chatid):
-                        return
-
-    async def _delay(self, chatid, userid):
-        if chatid != "global":
-            chatid = int(chatid)
-        if userid != "all":
-            userid = int(userid)
+                self._rule_stats(pending.rule)["dropped"] += 1
+                continue
+
+            chat_bucket = self._chat_bucket(utils.get_chat_id(pending.message))
+            wait = chat_bucket.wait_time(now)
+            if wait:
+                self._requeue(pending, now + wait)
+                continue
+
+            self._bucket.take(now)
+            chat_bucket.take(now)
+            task = asyncio.ensure_future(self._fire(pending))
+            self._inflight.add(task)
+            task.add_done_callback(self._fire_done)
+
+    def _fire_done(self, task: asyncio.Future):
+        self._inflight.discard(task)
+        self._wakeup.set()
+
+    async def _fire(self, pending: PendingReaction):
+        try:
+            await self._send_reaction(pending)
+        except FloodWaitError as exc:
+            self._paused_until = max(
+                self._paused_until,
+                time.monotonic() + exc.seconds,
+            )
+            logger.info("AutoReact paused for %ss by FloodWait", exc.seconds)
+            self._requeue(pending, self._paused_until)
+
+    async def _send_reaction(self, pending: PendingReaction):
+        allowed = await self._allowed_reactions(pending.message)
+        chatid = utils.get_chat_id(pending.message)
+        stats = self._rule_stats(pending.rule)
+        now = time.monotonic()
+        for i, emoji_reaction in enumerate(pending.emojis):
+            emoticon = emoji_reaction.replace("\ufe0f", "")
+            if allowed is not None and emoticon not in allowed:
+                continue
+            if self._invalid_reactions.get((chatid, emoticon), 0) > now:
+                continue
+            if await self._react_message(
+                pending.message,
+                emoji_reaction,
+                pending.rule.chatid,
+                stats,
+            ):
+                stats["success"] += 1
+                stats["fallback"] += bool(i)
+                stats["delay_total"] += pending.scheduled - pending.queued
+                stats["latency_total"] += time.monotonic() - pending.queued
+                return
+        stats["no_reaction"] += 1
+
+    def _rule_stats(self, rule: ReactionRule) -> collections.Counter:
+        stats = self._stats.get(rule.source)
+        if stats is None:
+            stats = self._stats[rule.source] = collections.Counter()
+        return stats
+
+    async def _allowed_reactions(
+        self,
+        message: Message,
+    ) -> typing.Optional[frozenset]:
+        """
+        Returns the emoticons allowed in the message's chat,
+        or None if every reaction is allowed.
+        """
+        chatid = utils.get_chat_id(message)
+        cached = self._allowed_cache.get(chatid)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        task = self._allowed_fetching.get(chatid)
+        if task is None:
+            task = self._allowed_fetching[chatid] = asyncio.ensure_future(
+                self._fetch_allowed_reactions(message)
+            )
+        return await asyncio.shield(task)
+
+    async def _fetch_allowed_reactions(
+        self,
+        message: Message,
+    ) -> typing.Optional[frozenset]:
+        chatid = utils.get_chat_id(message)
+        allowed = None
+        try:
+            if isinstance(message.peer_id, PeerChannel):
+                full = await self._client(
+                    GetFullChannelRequest(await message.get_input_chat())
+                )
+                available = full.full_chat.available_reactions
+            elif isinstance(message.peer_id, PeerChat):
+                full = await self._client(
+                    GetFullChatRequest(message.peer_id.chat_id)
+                )
+                available = full.full_chat.available_reactions
+            else:
+                available = None
+
+            if isinstance(available, ChatReactionsNone):
+                allowed = frozenset()
+            elif isinstance(available, ChatReactionsSome):
+                allowed = frozenset(
+                    reaction.emoticon.replace("\ufe0f", "")
+                    for reaction in available.reactions
+                    if isinstance(reaction, ReactionEmoji)
+                )
+        except Exception as exc:  # skipcq: PYL-W0703
+            logger.debug("Can't fetch reactions of chat %s: %s", chatid, exc)
+
+        now = time.monotonic()
+        self._allowed_cache[chatid] = (
+            now + self.config["reactions_cache_ttl"],
+            allowed,
+        )
+        self._invalid_reactions = {
+            key: expires
+            for key, expires in self._invalid_reactions.items()
+            if expires > now
+        }
+        del self._allowed_fetching[chatid]
+        return allowed
+
+    def _mark_invalid(self, message: Message, emoji_reaction: str):
+        self._invalid_reactions[
+            (utils.get_chat_id(message), emoji_reaction.replace("\ufe0f", ""))
+        ] = time.monotonic() + self.config["reactions_cache_ttl"]
+
+    def _delay(self, chatid, userid) -> float:
         if (
             chatid in self.config["delay_chats"]
             or userid in self.config["delay_chats"]
@@ -255,49 +892,56 @@ class AutoReactMod(loader.Module):
                 chatid not in self.config["random_delay_chats"]
                 or userid not in self.config["random_delay_chats"]
             ):
-                await asyncio.sleep(self.config["delay"])
-            else:
-                await asyncio.sleep(round(random.uniform(0, self.config["delay"]), 2))
+                return self.config["delay"] or 0
+            return round(random.uniform(0, self.config["delay"] or 0), 2)
+        return 0
 
-    @staticmethod
-    async def _reactions_chance(reactions_chance: list, message: Message) -> bool:
-        for r_chance in reactions_chance:
-            userid, chatid, chance = r_chance.split("|")
-            if userid == "all" and chatid == "global":
-                return False
-            if (
-                (str(message.sender_id) == userid or userid == "all")
-                and (str(utils.get_chat_id(message)) == chatid or chatid == "global")
-                and random.random() > float(chance)
-            ):
-                return False
-        return True
+    @classmethod
+    async def _reactions_chance(cls, chances: dict, message: Message) -> bool:
+        if not chances:
+            return True
+        chance = 1.0
+        for key in cls._rule_keys(message.sender_id, utils.get_chat_id(message)):
+            chance *= chances.get(key, 1.0)
+        return chance >= 1.0 or random.random() < chance
 
     async def _react_message(
         self,
         message: Message,
         emoji_reaction: str,
         chatid: int,
+        stats: typing.Optional[collections.Counter] = None,
     ) -> bool:
+        if stats is None:
+            stats = collections.Counter()
         try:
             await message.react(emoji_reaction)
             return True
+        except FloodWaitError:
+            raise
         except ReactionInvalidError:
+            stats["invalid"] += 1
+            self._mark_invalid(message, emoji_reaction)
             if self.config["raise_error"]:
-                self.apo_lib.utils.log(
-                    logging.INFO,
-                    __name__,
-                    f"ReactionInvalidError: {emoji_reaction} in chat {chatid}",
+                logger.info(
+                    "ReactionInvalidError: %s in chat %s",
+                    emoji_reaction,
+                    chatid,
                 )
             return False
         except Exception as exc:  # skipcq: PYL-W0703
+            if "PREMIUM_ACCOUNT_REQUIRED" in str(exc):
+                stats["premium_required"] += 1
+                self._mark_invalid(message, emoji_reaction)
+            else:
+                stats["errors"] += 1
             if self.config["raise_error"]:
                 if "PREMIUM_ACCOUNT_REQUIRED" in str(exc):
-                    self.apo_lib.utils.log(
-                        logging.INFO,
-                        __name__,
-                        f"PREMIUM_ACCOUNT_REQUIRED: {emoji_reaction} in chat {chatid}",
+                    logger.info(
+                        "PREMIUM_ACCOUNT_REQUIRED: %s in chat %s",
+                        emoji_reaction,
+                        chatid,
                     )
                 else:
-                    self.apo_lib.utils.log(logging.INFO, __name__, f"Error: {exc}")
+                    logger.info("Error: %s", exc)
             return False
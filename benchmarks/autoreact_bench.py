@@ -0,0 +1,251 @@
+"""
+Offline throughput benchmark for AutoReact's message matching.
+
+Runs `AutoReactMod.watcher`, `_reactions_chance` and `_delay` against
+synthetic rule sets and message streams. Hikka's `loader` and `utils`
+are replaced with minimal stand-ins, so only telethon has to be
+installed.
+
+    python benchmarks/autoreact_bench.py --rules 10,100,1000,10000
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import pathlib
+import random
+import statistics
+import sys
+import time
+import types
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+EMOJIS = ["❤️", "👍", "🔥", "🥰", "👏", "😁", "🎉", "🤩"]
+
+
+class _Strings:
+    def __init__(self, strings: dict):
+        self._strings = strings
+
+    def __call__(self, key: str, *_) -> str:
+        return self._strings.get(key, key)
+
+    __getitem__ = __call__
+
+
+class _Module:
+    strings = {}
+
+    def get_prefix(self) -> str:
+        return "."
+
+
+class _ConfigValue:
+    def __init__(self, option, default=None, doc=None, validator=None):
+        self.option = option
+        self.value = default
+
+
+class _ModuleConfig(dict):
+    def __init__(self, *values: _ConfigValue):
+        super().__init__((value.option, value.value) for value in values)
+
+
+class _Validators:
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def _passthrough(*args, **kwargs):
+    return lambda func: func
+
+
+def _stub_hikka():
+    package = types.ModuleType("hikka")
+    package.__path__ = []
+    modules = types.ModuleType("hikka.modules")
+    modules.__path__ = []
+
+    loader = types.ModuleType("hikka.loader")
+    loader.Module = _Module
+    loader.ModuleConfig = _ModuleConfig
+    loader.ConfigValue = _ConfigValue
+    loader.validators = _Validators()
+    loader.tds = lambda cls: cls
+    loader.watcher = _passthrough
+    loader.loop = _passthrough
+    loader.command = _passthrough
+
+    utils = types.ModuleType("hikka.utils")
+    utils.get_chat_id = lambda message: message.chat_id
+    utils.get_args = lambda message: []
+
+    async def answer(message, text, **kwargs):
+        return message
+
+    utils.answer = answer
+
+    package.loader = loader
+    package.utils = utils
+    sys.modules.update(
+        {
+            "hikka": package,
+            "hikka.modules": modules,
+            "hikka.loader": loader,
+            "hikka.utils": utils,
+        }
+    )
+
+
+def _load_module():
+    _stub_hikka()
+    spec = importlib.util.spec_from_file_location(
+        "hikka.modules.autoreact",
+        ROOT / "autoreact.py",
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeMessage:
+    __slots__ = ("sender_id", "chat_id", "out", "reactions")
+
+    def __init__(self, sender_id: int, chat_id: int):
+        self.sender_id = sender_id
+        self.chat_id = chat_id
+        self.out = False
+        self.reactions = None
+
+    async def react(self, emoji: str):
+        pass
+
+
+def make_rules(count: int, users: int, chats: int) -> list:
+    rules = []
+    for _ in range(count):
+        user = random.randint(1, users)
+        chat = random.randint(1, chats)
+        emojis = "|".join(random.sample(EMOJIS, random.randint(1, 3)))
+        kind = random.random()
+        if kind < 0.6:
+            rules.append(f"{user}|{chat}|{emojis}")
+        elif kind < 0.8:
+            rules.append(f"{user}|global|{emojis}")
+        else:
+            rules.append(f"all|{chat}|{emojis}")
+    return rules
+
+
+def make_chances(count: int, users: int, chats: int) -> list:
+    return [
+        f"{random.randint(1, users)}|{random.randint(1, chats)}|"
+        f"{random.choice(['0.5', '0.8', '1.0'])}"
+        for _ in range(count)
+    ]
+
+
+def make_messages(count: int, users: int, chats: int) -> list:
+    return [
+        FakeMessage(random.randint(1, users), random.randint(1, chats))
+        for _ in range(count)
+    ]
+
+
+def make_instance(module, rules: list, chances: list, chats: int):
+    mod = module.AutoReactMod()
+    mod.strings = _Strings(module.AutoReactMod.strings)
+    delay_chats = random.sample(range(1, chats + 1), min(chats, 10))
+    mod.config.update(
+        reactions=rules,
+        reactions_chance=chances,
+        delay_chats=delay_chats,
+        random_delay_chats=delay_chats[:5],
+        shuffle_reactions=[],
+    )
+    return mod
+
+
+async def _time_async(func, items: list) -> list:
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        await func(item)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _time_sync(func, items: list) -> list:
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        func(item)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(name: str, rules: int, latencies: list):
+    total = sum(latencies)
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"{name:<18}{rules:>8}{len(latencies) / total:>14.0f}"
+        f"{quantiles[49] * 1e6:>10.2f}{quantiles[94] * 1e6:>10.2f}"
+        f"{quantiles[98] * 1e6:>10.2f}"
+    )
+
+
+async def run(args):
+    module = _load_module()
+    print(
+        f"{'benchmark':<18}{'rules':>8}{'msgs/sec':>14}"
+        f"{'p50 µs':>10}{'p95 µs':>10}{'p99 µs':>10}"
+    )
+    for count in args.rules:
+        rules = make_rules(count, args.users, args.chats)
+        chances = make_chances(count, args.users, args.chats)
+        messages = make_messages(args.messages, args.users, args.chats)
+        mod = make_instance(module, rules, chances, args.chats)
+
+        mod._compile_rules()
+        report("watcher", count, await _time_async(mod.watcher, messages))
+        mod._pending.clear()
+
+        report(
+            "_reactions_chance",
+            count,
+            await _time_async(
+                lambda message: mod._reactions_chance(mod._chances, message),
+                messages,
+            ),
+        )
+
+        report(
+            "_delay",
+            count,
+            _time_sync(
+                lambda message: mod._delay(message.chat_id, message.sender_id),
+                messages,
+            ),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--rules",
+        type=lambda value: [int(count) for count in value.split(",")],
+        default=[10, 100, 1000, 10000],
+        help="comma separated rule counts",
+    )
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,195 @@
+import asyncio
+import collections
+import gzip
+import json
+import os
 import random
+import time
+import typing
 from telethon import types
 from telethon.tl.custom.message import Message
 from .. import loader, utils
 
+
+class ChatIndex:
+    """
+    Bounded per-chat index of words to message ids, plus the reply
+    threads seen for those messages.
+    """
+
+    max_words = 5000
+    max_ids_per_word = 50
+    max_threads = 2000
+    max_replies_per_thread = 20
+
+    def __init__(self):
+        self.words = collections.OrderedDict()
+        self.threads = collections.OrderedDict()
+
+    @staticmethod
+    def tokenize(text: str) -> set:
+        return {word.lower() for word in text.split() if len(word) >= 3}
+
+    def add(self, message: Message):
+        """
+        Indexes the words of a message and records it as a reply of its parent.
+        """
+        for word in self.tokenize(message.raw_text or ""):
+            ids = self.words.get(word)
+            if ids is None:
+                ids = self.words[word] = collections.deque(maxlen=self.max_ids_per_word)
+                if len(self.words) > self.max_words:
+                    self.words.popitem(last=False)
+            else:
+                self.words.move_to_end(word)
+            ids.append(message.id)
+
+        parent_id = message.reply_to.reply_to_msg_id if message.reply_to else None
+        if parent_id:
+            replies = self.threads.get(parent_id)
+            if replies is None:
+                replies = self.threads[parent_id] = collections.deque(maxlen=self.max_replies_per_thread)
+                if len(self.threads) > self.max_threads:
+                    self.threads.popitem(last=False)
+            replies.append(message.id)
+
+    def candidates(self, words: list) -> list:
+        """
+        Returns ids of indexed messages containing any of the words which have known replies.
+        """
+        return [
+            msg_id
+            for word in words
+            for msg_id in self.words.get(word.lower(), ())
+            if msg_id in self.threads
+        ]
+
+
+class ReplyPool:
+    """
+    Small rotating pool of ready reply messages keyed by trigger word.
+    """
+
+    max_words = 200
+    max_replies_per_word = 5
+
+    def __init__(self):
+        self.words = collections.OrderedDict()
+        self.size = 0
+
+    def add(self, word: str, reply_msg: Message):
+        """
+        Adds a reply for a trigger word, evicting the oldest word when full.
+        """
+        word = word.lower()
+        replies = self.words.get(word)
+        if replies is None:
+            replies = self.words[word] = collections.deque(maxlen=self.max_replies_per_word)
+            if len(self.words) > self.max_words:
+                self.size -= len(self.words.popitem(last=False)[1])
+        elif len(replies) == replies.maxlen:
+            self.size -= 1
+        replies.append(reply_msg)
+        self.size += 1
+
+    def take(self, words: list) -> typing.Optional[Message]:
+        """
+        Removes and returns a reply for one of the words, or None if none of them is pooled.
+        """
+        word = next((word.lower() for word in words if word.lower() in self.words), None)
+        if word is None:
+            return None
+        replies = self.words[word]
+        reply_msg = replies.popleft()
+        self.size -= 1
+        if not replies:
+            del self.words[word]
+        return reply_msg
+
+
+class MarkovModel:
+    """
+    Word-level second order Markov chain trained incrementally from chat messages.
+    """
+
+    max_prefixes = 50000
+    max_words = 30
+    version = 1
+
+    def __init__(self, chains: dict = None):
+        self.chains = chains or {}
+        self.dirty = False
+        # word -> words seen right before it, to start generating from any occurrence
+        self.seeds = collections.defaultdict(set)
+        for first, second in self.chains:
+            self.seeds[second].add(first)
+
+    def train(self, text: str):
+        """
+        Adds the word transitions of a message to the model.
+        """
+        words = text.split()
+        if len(words) < 2:
+            return
+        prefix = ("", "")
+        for word in words + [""]:
+            followers = self.chains.get(prefix)
+            if followers is None:
+                if len(self.chains) >= self.max_prefixes:
+                    prefix = (prefix[1], word)
+                    continue
+                followers = self.chains[prefix] = {}
+                self.seeds[prefix[1]].add(prefix[0])
+            followers[word] = followers.get(word, 0) + 1
+            prefix = (prefix[1], word)
+        self.dirty = True
+
+    def generate(self, seed: str = "") -> str:
+        """
+        Generates a message continuing from the seed word wherever the model has seen it.
+        """
+        firsts = self.seeds.get(seed) if seed else None
+        prefix = (random.choice(list(firsts)), seed) if firsts else ("", "")
+        words = [word for word in prefix if word]
+        while len(words) < self.max_words:
+            followers = self.chains.get(prefix)
+            if not followers:
+                break
+            word = random.choices(list(followers), weights=list(followers.values()))[0]
+            if not word:
+                break
+            words.append(word)
+            prefix = (prefix[1], word)
+        return " ".join(words)
+
+    def copy(self) -> "MarkovModel":
+        """
+        Returns a snapshot of the model that later training doesn't change.
+        """
+        return MarkovModel({prefix: dict(followers) for prefix, followers in self.chains.items()})
+
+    def dumps(self) -> bytes:
+        """
+        Serializes the model into gzip-compressed JSON.
+        """
+        return gzip.compress(
+            json.dumps(
+                {
+                    "version": self.version,
+                    "chains": [[first, second, followers] for (first, second), followers in self.chains.items()],
+                },
+                ensure_ascii=False,
+                separators=(",", ":"),
+            ).encode()
+        )
+
+    @classmethod
+    def loads(cls, data: bytes) -> "MarkovModel":
+        payload = json.loads(gzip.decompress(data))
+        if payload.get("version") != cls.version:
+            return cls()
+        return cls({(first, second): followers for first, second, followers in payload["chains"]})
+
 @loader.tds
 class MegaMozgMod(loader.Module):
     """
@@ -15,13 +202,92 @@ class MegaMozgMod(loader.Module):
         "status": "{}Шанс встановлено на {}",
         "on": "{}Ввімкнено",
         "off": "{}Вимкнено",
+        "indexed": "{}Проіндексовано {} повідомлень",
+        "mode": "{}Режим відповідей: {}",
     }
 
     _db_name = "MegaMozg"
     _default_chance = 0
+    _default_backfill = 1000
+    _reply_sample_size = 50
+    _reply_cache_ttl = 600
+    _reply_cache_size = 500
+    _search_limit = 100
+    _search_timeout = 10
+    _search_cooldown = 15
+    _max_candidates = 50
+    _pool_target = 50
+    _pool_fetch_size = 100
+    _pool_budget = 30
+    _pool_chat_budget = 10
+    _pool_sample_words = 200
+    _pool_search_words = 2
+    _modes = ("search", "markov")
+    _models_dir = os.path.join(os.path.expanduser("~"), ".megamozg")
 
     async def client_ready(self, client, db):
         self.db = db
+        self._me_id = (await client.get_me()).id
+        self._active_chats = frozenset(self.db.get(self._db_name, "chats", []))
+        self._chance = self.db.get(self._db_name, "chance", self._default_chance)
+        self._indexes = {}
+        self._reply_cache = collections.OrderedDict()
+        self._client = client
+        self._refreshing = set()
+        self._refresh_tasks = set()
+        self._search_cooldowns = {}
+        self._pools = {}
+        self._pool_budget_left = self._pool_budget
+        self._mode = self.db.get(self._db_name, "mode", "search")
+        self._models = {}
+
+    def get_index(self, chat_id: int) -> ChatIndex:
+        """
+        Returns the local reply index of a chat, creating it if needed.
+        """
+        if chat_id not in self._indexes:
+            self._indexes[chat_id] = ChatIndex()
+        return self._indexes[chat_id]
+
+    def get_model(self, chat_id: int) -> MarkovModel:
+        """
+        Returns the Markov model of a chat, loading it from disk on first use.
+        """
+        if chat_id not in self._models:
+            model = MarkovModel()
+            path = os.path.join(self._models_dir, f"{chat_id}.json.gz")
+            if os.path.exists(path):
+                try:
+                    with open(path, "rb") as file:
+                        model = MarkovModel.loads(file.read())
+                except (OSError, ValueError):
+                    pass
+            self._models[chat_id] = model
+        return self._models[chat_id]
+
+    @staticmethod
+    def write_model(path: str, model: MarkovModel):
+        """
+        Serializes a model snapshot and writes it atomically.
+        """
+        data = model.dumps()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "wb") as file:
+            file.write(data)
+        os.replace(f"{path}.tmp", path)
+
+    @loader.loop(interval=300, autostart=True)
+    async def save_models(self):
+        """
+        Periodically flushes changed Markov models to disk.
+        Encoding and compression run in the executor on a snapshot of the chains.
+        """
+        for chat_id, model in list(self._models.items()):
+            if not model.dirty:
+                continue
+            model.dirty = False
+            path = os.path.join(self._models_dir, f"{chat_id}.json.gz")
+            await asyncio.get_event_loop().run_in_executor(None, self.write_model, path, model.copy())
 
     @staticmethod
     def str2bool(value: str) -> bool:
@@ -34,27 +300,29 @@ class MegaMozgMod(loader.Module):
 
     def get_active_chats(self) -> set:
         """
-        Fetches the set of chats where the mode is enabled.
+        Returns the set of chats where the mode is enabled.
         """
-        return set(self.db.get(self._db_name, "chats", []))
+        return set(self._active_chats)
 
     def set_active_chats(self, chats: set):
         """
-        Updates the list of active chats in the database.
+        Updates the list of active chats in the database and in memory.
         """
         self.db.set(self._db_name, "chats", list(chats))
+        self._active_chats = frozenset(chats)
 
     def get_reply_chance(self) -> int:
         """
-        Retrieves the current reply chance from the database. Defaults to 0 if not set.
+        Returns the current reply chance. Defaults to 0 if not set.
         """
-        return self.db.get(self._db_name, "chance", self._default_chance)
+        return self._chance
 
     def set_reply_chance(self, chance: int):
         """
-        Sets the reply chance in the database.
+        Sets the reply chance in the database and in memory.
         """
         self.db.set(self._db_name, "chance", chance)
+        self._chance = chance
 
     async def mozgcmd(self, message: Message):
         """
@@ -91,20 +359,52 @@ class MegaMozgMod(loader.Module):
         self.set_reply_chance(chance)
         return await utils.answer(message, self.strings["status"].format(self.strings["pref"], chance))
 
+    async def mozgmodecmd(self, message: Message):
+        """
+        .mozgmode <search/markov> - Reply with messages found in the chat or with text generated locally.
+        """
+        args = utils.get_args_raw(message).strip().lower()
+        if args not in self._modes:
+            return await utils.answer(message, self.strings["need_arg"].format(self.strings["pref"]))
+
+        self._mode = args
+        self.db.set(self._db_name, "mode", args)
+        return await utils.answer(message, self.strings["mode"].format(self.strings["pref"], args))
+
+    async def mozgindexcmd(self, message: Message):
+        """
+        .mozgindex [N] - Index the last N messages of the chat (1000 by default).
+        """
+        args = utils.get_args_raw(message)
+        limit = int(args) if args.isdigit() else self._default_backfill
+        chat_index = self.get_index(message.chat_id)
+        model = self.get_model(message.chat_id) if self._mode == "markov" else None
+        count = 0
+        async for msg in message.client.iter_messages(message.chat_id, limit=limit):
+            if isinstance(msg, types.Message):
+                chat_index.add(msg)
+                if model:
+                    model.train(msg.raw_text or "")
+                count += 1
+        return await utils.answer(message, self.strings["indexed"].format(self.strings["pref"], count))
+
     async def watcher(self, message: Message):
         """
         Watches the chat for messages and replies based on a set chance and random word matching.
         """
         if not isinstance(message, types.Message):
             return
-        if message.sender_id == (await message.client.get_me()).id or not message.chat_id:
-            return
 
         chat_id = message.chat_id
-        active_chats = self.get_active_chats()
-        if chat_id not in active_chats:
+        if chat_id not in self._active_chats or message.sender_id == self._me_id:
             return
 
+        chat_index = self.get_index(chat_id)
+        chat_index.add(message)
+        # chat text is only kept in a model (and saved to disk) once markov mode is chosen
+        if self._mode == "markov":
+            self.get_model(chat_id).train(message.raw_text or "")
+
         if not self.should_reply():
             return
 
@@ -112,17 +412,40 @@ class MegaMozgMod(loader.Module):
         if not selected_words:
             return
 
-        messages = await self.search_for_messages(message, selected_words)
-        if not messages:
+        if self._mode == "markov":
+            text = self.get_model(chat_id).generate(random.choice(selected_words))
+            if text:
+                await message.reply(utils.escape_html(text))
             return
 
-        await self.reply_to_random_message(message, messages)
+        reply_msg = self.get_pool(chat_id).take(selected_words)
+        if reply_msg:
+            return await message.reply(reply_msg)
+
+        candidates = chat_index.candidates(selected_words)
+        if candidates:
+            await self.reply_from_index(message, chat_index, candidates)
+
+        if chat_id not in self._refreshing and self._search_cooldowns.get(chat_id, 0) <= time.monotonic():
+            self._search_cooldowns[chat_id] = time.monotonic() + self._search_cooldown
+            task = asyncio.ensure_future(self.refresh_pool_budgeted(chat_id, selected_words))
+            self._refresh_tasks.add(task)
+            task.add_done_callback(self._refresh_tasks.discard)
+
+    async def reply_from_index(self, message: Message, chat_index: ChatIndex, candidates: list):
+        """
+        Replies with a random known reply to a random indexed candidate message.
+        """
+        reply_id = random.choice(chat_index.threads[random.choice(candidates)])
+        reply_msg = await message.client.get_messages(message.chat_id, ids=reply_id)
+        if reply_msg:
+            await message.reply(reply_msg)
 
     def should_reply(self) -> bool:
         """
         Determines if the bot should reply based on the set chance.
         """
-        chance = self.get_reply_chance()
+        chance = self._chance
         return chance == 0 or random.randint(0, chance) == 0
 
     def extract_random_words(self, text: str, count: int) -> list:
@@ -132,30 +455,136 @@ class MegaMozgMod(loader.Module):
         words = list(filter(lambda x: len(x) >= 3, text.split()))
         return random.sample(words, count) if len(words) >= count else []
 
-    async def search_for_messages(self, message: Message, words: list) -> list:
+    async def search_for_messages(self, chat_id: int, words: list) -> list:
         """
         Searches the chat for messages that contain any of the given words.
+        Words are searched concurrently, with a cap on results and an overall timeout.
         """
-        found_messages = []
-        for word in words:
-            async for msg in message.client.iter_messages(message.chat_id, search=word):
-                if msg.replies and msg.replies.max_id:
-                    found_messages.append(msg)
-        return found_messages
 
-    async def reply_to_random_message(self, message: Message, messages: list):
+        async def search_word(word: str) -> list:
+            return [
+                msg
+                async for msg in self._client.iter_messages(chat_id, search=word, limit=self._search_limit)
+                if msg.replies and msg.replies.max_id
+            ]
+
+        try:
+            results = await asyncio.wait_for(
+                asyncio.gather(*(search_word(word) for word in words)),
+                timeout=self._search_timeout,
+            )
+        except asyncio.TimeoutError:
+            return []
+        return [msg for found in results for msg in found][: self._max_candidates]
+
+    async def get_thread_replies(self, chat_id: int, root_id: int) -> list:
         """
-        Selects a random message from the list and replies to a random message in its reply thread.
+        Fetches a sample of direct replies to a message through the replies API.
+        Results are cached per (chat, root message) for a while.
         """
-        chosen_msg = random.choice(messages)
-        start_id = chosen_msg.id
-        end_id = chosen_msg.replies.max_id
+        key = (chat_id, root_id)
+        cached = self._reply_cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
 
-        reply_msgs = [
-            msg async for msg in message.client.iter_messages(message.chat_id, ids=list(range(start_id + 1, end_id + 1)))
-            if msg and msg.reply_to and msg.reply_to.reply_to_msg_id == start_id
-        ]
+        try:
+            reply_msgs = [
+                msg
+                async for msg in self._client.iter_messages(
+                    chat_id, reply_to=root_id, limit=self._reply_sample_size
+                )
+                if msg.reply_to and msg.reply_to.reply_to_msg_id == root_id
+            ]
+        except Exception:
+            reply_msgs = []
 
-        if reply_msgs:
-            reply_msg = random.choice(reply_msgs)
-            await message.reply(reply_msg)
+        self._reply_cache[key] = (time.monotonic() + self._reply_cache_ttl, reply_msgs)
+        self._reply_cache.move_to_end(key)
+        if len(self._reply_cache) > self._reply_cache_size:
+            self._reply_cache.popitem(last=False)
+        return reply_msgs
+
+    def get_pool(self, chat_id: int) -> ReplyPool:
+        """
+        Returns the candidate reply pool of a chat, creating it if needed.
+        """
+        if chat_id not in self._pools:
+            self._pools[chat_id] = ReplyPool()
+        return self._pools[chat_id]
+
+    async def refresh_pool(self, chat_id: int, budget: int, words: list = None) -> int:
+        """
+        Adds candidate replies to the pool of a chat, making at most `budget` API calls.
+        The given words are pooled first, then a sample of indexed words.
+        Reply ids come from the local index and are fetched in one request,
+        the server-side search is used when the index has none.
+        Returns the number of API calls made.
+        """
+        if chat_id in self._refreshing:
+            return 0
+
+        self._refreshing.add(chat_id)
+        used = 0
+        try:
+            chat_index = self.get_index(chat_id)
+            pool = self.get_pool(chat_id)
+            sample = list(chat_index.words)[-self._pool_sample_words:]
+            random.shuffle(sample)
+            priority = [word.lower() for word in words or ()]
+            words = list(dict.fromkeys(priority + sample))
+            picks = []
+            for word in words:
+                if len(picks) >= min(self._pool_target - pool.size, self._pool_fetch_size):
+                    break
+                candidates = chat_index.candidates([word])
+                if candidates:
+                    picks.append((word, random.choice(chat_index.threads[random.choice(candidates)])))
+
+            if picks and used < budget:
+                used += 1
+                try:
+                    reply_msgs = await self._client.get_messages(chat_id, ids=[reply_id for _, reply_id in picks])
+                except Exception:
+                    reply_msgs = []
+                for (word, _), reply_msg in zip(picks, reply_msgs):
+                    if reply_msg:
+                        pool.add(word, reply_msg)
+
+            for word in words[: self._pool_search_words]:
+                if used + 2 > budget or pool.size:
+                    break
+                used += 1
+                found = await self.search_for_messages(chat_id, [word])
+                if not found:
+                    continue
+                used += 1
+                replies = await self.get_thread_replies(chat_id, random.choice(found).id)
+                if replies:
+                    pool.add(word, random.choice(replies))
+        finally:
+            self._refreshing.discard(chat_id)
+        return used
+
+    @loader.loop(interval=120, autostart=True)
+    async def refresh_pools(self):
+        """
+        Keeps the reply pools of active chats filled within a global API budget per run.
+        """
+        self._pool_budget_left = self._pool_budget
+        for chat_id in sorted(self._active_chats, key=lambda chat: self.get_pool(chat).size):
+            if self._pool_budget_left <= 0:
+                break
+            await self.refresh_pool_budgeted(chat_id)
+
+    async def refresh_pool_budgeted(self, chat_id: int, words: list = None) -> int:
+        """
+        Refreshes the pool of a chat, charging the API calls to the global budget
+        shared by the watcher and the periodic refresh.
+        """
+        budget = min(self._pool_budget_left, self._pool_chat_budget)
+        if budget <= 0:
+            return 0
+        self._pool_budget_left -= budget
+        used = await self.refresh_pool(chat_id, budget, words)
+        self._pool_budget_left = min(self._pool_budget, self._pool_budget_left + budget - used)
+        return used
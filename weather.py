@@ -4,12 +4,25 @@ import logging
 import asyncio
 import aiohttp
 from datetime import datetime, time
+from time import monotonic
+from telethon.errors import MessageNotModifiedError
 from .. import loader, utils
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.DEBUG)
 
 API_URL_OWM = "https://api.openweathermap.org/data/2.5/weather"
+API_URL_OWM_GROUP = "https://api.openweathermap.org/data/2.5/group"
+GROUP_SIZE = 20
+WEATHERALL_CONCURRENCY = 5
+UNITS = "metric"
+LANG = "uk"
+STALE_FACTOR = 6
+HTTP_CONNECTION_LIMIT = 10
+HTTP_DNS_CACHE_TTL = 600
+HTTP_KEEPALIVE_TIMEOUT = 60
+HTTP_TOTAL_TIMEOUT = 15
+HTTP_CONNECT_TIMEOUT = 5
 
 @loader.tds
 class WeatherMod(loader.Module):
@@ -76,13 +89,29 @@ class WeatherMod(loader.Module):
             ),
         )
         self.cache = {}
+        self._pending = {}
+        self._session = None
+        self._last_broadcast = None
 
     async def client_ready(self, client, db):
         """Ініціалізація клієнта та бази даних."""
         self.db = db
         self.client = client
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=HTTP_CONNECTION_LIMIT,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ),
+            timeout=aiohttp.ClientTimeout(total=HTTP_TOTAL_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        )
         logger.info("Клієнт готовий, запуск модуля Погода.")
 
+    async def on_unload(self):
+        """Закрити HTTP сесію при вивантаженні модуля."""
+        if self._session:
+            await self._session.close()
+
     async def addcitycmd(self, message):
         """Додати місто до списку обраних."""
         city = utils.get_args_raw(message)
@@ -120,6 +149,114 @@ class WeatherMod(loader.Module):
         cities_list = "\n".join([f"• {city}" for city in cities])
         await utils.answer(message, self.strings["list_cities"].format(cities_list))
 
+    async def addchatcmd(self, message):
+        """Додати цей чат до розсилки погоди. [місто] - інакше основне місто."""
+        city = utils.get_args_raw(message).strip()
+        chats = self.db.get(self.strings["name"], "chats", {})
+        chats[str(message.chat_id)] = city
+        self.db.set(self.strings["name"], "chats", chats)
+        await utils.answer(message, self.strings["chat_added"])
+
+    async def removechatcmd(self, message):
+        """Видалити цей чат з розсилки погоди."""
+        chats = self.db.get(self.strings["name"], "chats", {})
+        chats.pop(str(message.chat_id), None)
+        self.db.set(self.strings["name"], "chats", chats)
+        message_ids = self.db.get(self.strings["name"], "broadcast_messages", {})
+        message_ids.pop(str(message.chat_id), None)
+        self.db.set(self.strings["name"], "broadcast_messages", message_ids)
+        await utils.answer(message, self.strings["chat_removed"])
+
+    async def listchatscmd(self, message):
+        """Показати чати розсилки погоди."""
+        chats = self.db.get(self.strings["name"], "chats", {})
+        if not chats:
+            return await utils.answer(message, "<b>Список чатів для розсилки порожній.</b>")
+
+        chats_list = "\n".join(
+            f"• <code>{chat_id}</code> — {city or self.config['default_city'] or '—'}"
+            for chat_id, city in chats.items()
+        )
+        await utils.answer(message, self.strings["list_chats"].format(chats_list))
+
+    @staticmethod
+    def is_silent_time():
+        """Чи зараз режим тиші (22:30 - 06:30)."""
+        now = datetime.now().time()
+        return now >= time(22, 30) or now < time(6, 30)
+
+    @loader.loop(interval=60, autostart=True)
+    async def broadcaster(self):
+        """Розсилка погоди: кожне місто запитується раз за тік для всіх підписаних чатів."""
+        if not self.config["api_key"] or not self._session:
+            return
+        if (
+            self._last_broadcast is not None
+            and monotonic() - self._last_broadcast < self.config["update_frequency"] * 60
+        ):
+            return
+        if self.config["silent_mode"] and self.is_silent_time():
+            return
+
+        chats = self.db.get(self.strings["name"], "chats", {})
+        if not chats:
+            return
+        self._last_broadcast = monotonic()
+
+        subscribers = {}
+        for chat_id, city in chats.items():
+            city = city or self.config["default_city"]
+            if city:
+                subscribers.setdefault(self.cache_key(city)[0], (city, []))[1].append(int(chat_id))
+
+        # розсилка не віддає застарілі дані, інакше кожен тік показував би попередній
+        results = await self.get_weather_many([city for city, _ in subscribers.values()], fresh=True)
+        message_ids = self.db.get(self.strings["name"], "broadcast_messages", {})
+        for city, chat_ids in subscribers.values():
+            data = results.get(city)
+            if not data:
+                continue
+            text = self.strings["weather_response"].format(city, self.format_weather(data))
+            for chat_id in chat_ids:
+                message_id = await self.broadcast_to(chat_id, message_ids.get(str(chat_id)), text)
+                if message_id:
+                    message_ids[str(chat_id)] = message_id
+        self.db.set(self.strings["name"], "broadcast_messages", message_ids)
+
+    async def broadcast_to(self, chat_id, message_id, text):
+        """Редагувати попереднє повідомлення розсилки або надіслати нове."""
+        if message_id:
+            try:
+                await self.client.edit_message(chat_id, message_id, text)
+                return message_id
+            except MessageNotModifiedError:
+                return message_id
+            except Exception:
+                pass
+
+        try:
+            return (await self.client.send_message(chat_id, text)).id
+        except Exception as e:
+            logger.warning(f"Не вдалося надіслати погоду в чат {chat_id}: {e}")
+            return None
+
+    async def weatherallcmd(self, message):
+        """Показати погоду для всіх обраних міст."""
+        cities = self.db.get(self.strings["name"], "cities", [])
+        if not cities:
+            return await utils.answer(message, "<b>Список обраних міст порожній.</b>")
+        if not self.config["api_key"]:
+            return await utils.answer(message, "❌ API ключ не заданий.")
+
+        results = await self.get_weather_many(cities)
+        report = "\n\n".join(
+            self.strings["weather_response"].format(city, self.format_weather(results[city]))
+            if results.get(city)
+            else self.strings["weather_no_city"].format(city)
+            for city in cities
+        )
+        await utils.answer(message, report)
+
     async def weathercmd(self, message):
         """Показати погоду для основного міста."""
         city = self.config["default_city"]
@@ -130,24 +267,135 @@ class WeatherMod(loader.Module):
 
     async def get_weather(self, message, city):
         """Отримати погоду для заданого міста."""
-        api_key = self.config["api_key"]
-        if not api_key:
+        if not self.config["api_key"]:
             return await utils.answer(message, "❌ API ключ не заданий.")
 
-        params = {"q": city, "appid": api_key, "units": "metric", "lang": "uk"}
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(API_URL_OWM, params=params) as response:
-                    if response.status != 200:
-                        return await utils.answer(message, self.strings["weather_no_city"].format(city))
-
-                    data = await response.json()
-                    weather = self.strings["weather_format"].format(
-                        data["main"]["temp"], data["wind"]["speed"],
-                        data["main"]["humidity"], data["main"]["pressure"],
-                        data["main"]["feels_like"], data["clouds"]["all"]
-                    )
-                    await utils.answer(message, self.strings["weather_response"].format(city, weather))
+            data = await self.get_weather_data(city)
         except Exception as e:
             logger.exception(f"Помилка отримання погоди для {city}: {e}")
-            await utils.answer(message, "❌ Помилка отримання даних погоди.")
+            return await utils.answer(message, "❌ Помилка отримання даних погоди.")
+
+        if not data:
+            return await utils.answer(message, self.strings["weather_no_city"].format(city))
+
+        await utils.answer(message, self.strings["weather_response"].format(city, self.format_weather(data)))
+
+    def format_weather(self, data):
+        """Форматувати відповідь OpenWeatherMap."""
+        return self.strings["weather_format"].format(
+            data["main"]["temp"], data["wind"]["speed"],
+            data["main"]["humidity"], data["main"]["pressure"],
+            data["main"]["feels_like"], data["clouds"]["all"]
+        )
+
+    @staticmethod
+    def cache_key(city):
+        """Ключ кешу: нормалізоване місто, одиниці та мова."""
+        return (" ".join(city.split()).lower(), UNITS, LANG)
+
+    async def get_weather_data(self, city, fresh=False):
+        """Погода з кешу. Застарілі дані віддаються одразу, а оновлення йде у фоні.
+        З fresh=True застарілі дані не віддаються, а чекається оновлення."""
+        key = self.cache_key(city)
+        cached = self.cache.get(key)
+        if cached:
+            age = monotonic() - cached[0]
+            if age <= self.config["cache_timeout"]:
+                return cached[1]
+            if not fresh and age <= self.config["cache_timeout"] * STALE_FACTOR:
+                self.refresh_weather(key, city)
+                return cached[1]
+        return await asyncio.shield(self.refresh_weather(key, city))
+
+    def refresh_weather(self, key, city):
+        """Один запит на місто: паралельні виклики чекають на той самий."""
+        task = self._pending.get(key)
+        if task is None:
+            task = self._pending[key] = asyncio.ensure_future(self.fetch_weather(key, city))
+            task.add_done_callback(lambda done: self.on_refresh_done(key, done))
+        return task
+
+    def on_refresh_done(self, key, task):
+        """Прибрати завершений запит і залогувати помилку фонового оновлення."""
+        self._pending.pop(key, None)
+        if not task.cancelled() and task.exception() and key in self.cache:
+            logger.warning(f"Не вдалося оновити погоду для {key[0]}: {task.exception()}")
+
+    async def fetch_weather(self, key, city):
+        """Запит до OpenWeatherMap. None, якщо місто не знайдено."""
+        params = {"q": city, "appid": self.config["api_key"], "units": UNITS, "lang": LANG}
+        async with self._session.get(API_URL_OWM, params=params) as response:
+            if response.status != 200:
+                return None
+            data = await response.json()
+
+        self.cache[key] = (monotonic(), data)
+        self.remember_city_id(key, data.get("id"))
+        return data
+
+    def remember_city_id(self, key, city_id):
+        """Запам'ятати id міста OpenWeatherMap для групових запитів."""
+        city_ids = self.db.get(self.strings["name"], "city_ids", {})
+        if city_id and city_ids.get(key[0]) != city_id:
+            city_ids[key[0]] = city_id
+            self.db.set(self.strings["name"], "city_ids", city_ids)
+
+    async def fetch_group(self, cities, city_ids):
+        """Погода для до 20 міст з відомими id одним запитом."""
+        keys = {city: self.cache_key(city) for city in cities}
+        params = {
+            "id": ",".join(str(city_ids[key[0]]) for key in keys.values()),
+            "appid": self.config["api_key"],
+            "units": UNITS,
+            "lang": LANG,
+        }
+        async with self._session.get(API_URL_OWM_GROUP, params=params) as response:
+            if response.status != 200:
+                return {}
+            payload = await response.json()
+
+        by_id = {item["id"]: item for item in payload.get("list", [])}
+        now = monotonic()
+        results = {}
+        for city, key in keys.items():
+            data = by_id.get(city_ids[key[0]])
+            if data:
+                self.cache[key] = (now, data)
+                results[city] = data
+        return results
+
+    async def get_weather_many(self, cities, fresh=False):
+        """Погода для кількох міст: кеш, групові запити за id та паралельні запити для решти."""
+        semaphore = asyncio.Semaphore(WEATHERALL_CONCURRENCY)
+        city_ids = self.db.get(self.strings["name"], "city_ids", {})
+        results = {}
+
+        def usable_cache(city):
+            cached = self.cache.get(self.cache_key(city))
+            max_age = self.config["cache_timeout"] * (1 if fresh else STALE_FACTOR)
+            return cached and monotonic() - cached[0] <= max_age
+
+        grouped = [city for city in cities if not usable_cache(city) and self.cache_key(city)[0] in city_ids]
+
+        async def group(batch):
+            async with semaphore:
+                try:
+                    results.update(await self.fetch_group(batch, city_ids))
+                except Exception as e:
+                    logger.warning(f"Груповий запит погоди не вдався: {e}")
+
+        await asyncio.gather(
+            *(group(grouped[i:i + GROUP_SIZE]) for i in range(0, len(grouped), GROUP_SIZE))
+        )
+
+        async def single(city):
+            async with semaphore:
+                try:
+                    results[city] = await self.get_weather_data(city, fresh)
+                except Exception as e:
+                    logger.warning(f"Помилка отримання погоди для {city}: {e}")
+                    results[city] = None
+
+        await asyncio.gather(*(single(city) for city in cities if city not in results))
+        return results